@@ -1,8 +1,17 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g, has_app_context, \
+    send_from_directory, jsonify, abort
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from werkzeug.security import generate_password_hash, check_password_hash
+from functools import wraps
+import click
+import hashlib
 import os
-from datetime import datetime
+import re
+import tempfile
+import time
+from datetime import datetime, timedelta
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -11,32 +20,454 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///urban_orientation.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'static/images'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['ADMIN_PAGE_SIZE'] = 20  # Rows per page on admin list pages
+app.config['UPLOAD_CHUNK_SIZE'] = 64 * 1024  # Bytes read per chunk when storing uploads
+app.config['PRERENDER_MESSAGES'] = True  # Store each chat message's HTML when it is written
+app.config['REPLICA_STICKY_SECONDS'] = 10  # Read from the primary this long after a user's chat POST
+app.config['SNAPSHOT_FOLDER'] = 'static/snapshots'  # Pre-rendered public pages for anonymous visitors
+app.config['CHAT_DELTA_SYNC'] = True  # Chat pages cache history in the browser and fetch only new messages
+app.config['CHAT_CACHE_COOKIE'] = 'chat_cached'  # Set by main.js once a chat's history is cached locally
+
+# Optional read-only replica of the main database
+if os.environ.get('REPLICA_DATABASE_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {'replica': os.environ['REPLICA_DATABASE_URL']}
+
+class RoutingSession(Session):
+    """Session that sends SELECTs to the replica inside routes marked with @read_replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and getattr(clause, 'is_select', False) \
+           and has_app_context() and g.get('use_replica') and 'replica' in self._db.engines:
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
 # Initialize database
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 
 # Initialize models with the db instance
 from models import init_db
 init_db(db)
-from models import User, Admin, Activity, Keyword, Content, Conversation
+from models import User, Admin, Activity, Keyword, Content, Conversation, PhotoBlob, RenderedMessage, ChatMessage, ChatUser
 
 # Create tables
 with app.app_context():
     db.create_all()
 
+# Read replica helpers
+def read_replica(view):
+    """Route the read queries of a view's GET requests to the replica, when one is configured.
+
+    Users who just posted a chat message keep reading from the primary for
+    REPLICA_STICKY_SECONDS so they always see their own writes.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET' and session.get('read_primary_until', 0) < time.time():
+            g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def stick_to_primary():
+    """Keep this user's reads on the primary until the replica has caught up with their write"""
+    session['read_primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+
+def read_from_primary():
+    """Send the remaining reads of this request to the primary, e.g. when the replica lags behind"""
+    g.use_replica = False
+
+# Chat history helpers
+def load_chat_history(user_id, activity_id=None, newest_first=False, after_id=None, with_html=True):
+    """Return (user, messages) for a user with one query.
+
+    The user is a ChatUser tuple and messages are ChatMessage tuples rather than
+    ORM instances, so long histories don't fill the session's identity map. The
+    user is None when it no longer exists. ``html`` is the pre-rendered message body, or None
+    when it is missing or was rendered by an older version of the partial.
+    Pass ``after_id`` to load only messages newer than a conversation id, and
+    ``with_html=False`` to skip loading the pre-rendered bodies when they aren't displayed.
+    """
+    join_on = Conversation.user_id == User.id
+    if activity_id is not None:
+        join_on = db.and_(join_on, Conversation.activity_id == activity_id)
+    if after_id is not None:
+        join_on = db.and_(join_on, Conversation.id > after_id)
+    order = Conversation.timestamp.desc() if newest_first else Conversation.timestamp
+
+    query = db.session.query(User.id,
+                             User.username,
+                             User.email,
+                             User.created_at,
+                             Conversation.id,
+                             Conversation.activity_id,
+                             Conversation.sender_type,
+                             Conversation.message,
+                             Conversation.timestamp) \
+                      .outerjoin(Conversation, join_on)
+    if with_html:
+        query = query.add_columns(RenderedMessage.html, RenderedMessage.template_version) \
+                     .outerjoin(RenderedMessage, RenderedMessage.conversation_id == Conversation.id)
+    rows = query.filter(User.id == user_id).order_by(order).all()
+    if not rows:
+        return None, []
+
+    # The outer join yields a single row with no conversation when the history is empty
+    messages = [ChatMessage(*row[4:9], row[9] if with_html and row[10] == MESSAGE_TEMPLATE_VERSION else None)
+                for row in rows if row[4] is not None]
+    return ChatUser(*rows[0][:4]), messages
+
+def chat_cache_owner(user):
+    """Token identifying whose chat a browser cache holds, so a recreated account never reuses it"""
+    return hashlib.sha256(f"{user.id}:{user.created_at}".encode('utf-8')).hexdigest()[:16]
+
+def template_version(template_name):
+    """Short hash of a template's source, used to detect stale pre-rendered output"""
+    source, _, _ = app.jinja_loader.get_source(app.jinja_env, template_name)
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
+MESSAGE_TEMPLATE_VERSION = template_version('partials/message_content.html')
+
+def render_message_html(message):
+    """Render a message body with the message partial, which escapes all user text"""
+    return render_template('partials/message_content.html', message_content=message)
+
+def store_message_html(conversations):
+    """Pre-render newly written Conversation rows; ids must already be assigned by a flush"""
+    for conv in conversations:
+        db.session.add(RenderedMessage(
+            conversation_id=conv.id,
+            html=render_message_html(conv.message),
+            template_version=MESSAGE_TEMPLATE_VERSION
+        ))
+
+def fill_message_html(messages):
+    """Render the messages that have no up-to-date HTML yet and persist the result"""
+    stale = [msg._replace(html=render_message_html(msg.message)) for msg in messages if msg.html is None]
+    if not stale:
+        return messages
+
+    # Replace outdated renders in bulk rather than merging row by row
+    rendered = {msg.id: msg for msg in stale}
+    try:
+        RenderedMessage.query.filter(RenderedMessage.conversation_id.in_(list(rendered))) \
+                             .delete(synchronize_session=False)
+        db.session.add_all([
+            RenderedMessage(conversation_id=msg.id, html=msg.html, template_version=MESSAGE_TEMPLATE_VERSION)
+            for msg in stale
+        ])
+        db.session.commit()
+    except SQLAlchemyError:
+        # Usually a concurrent view stored the same renders first; the page still uses ours
+        db.session.rollback()
+        app.logger.warning('Could not store pre-rendered messages', exc_info=True)
+    return [rendered.get(msg.id, msg) for msg in messages]
+
+# Admin list helpers
+def keyset_page(query, id_column):
+    """Return one page of rows (newest first) after the ``after`` cursor, plus the next cursor"""
+    per_page = app.config['ADMIN_PAGE_SIZE']
+    after = request.args.get('after', type=int)
+    if after:
+        query = query.filter(id_column < after)
+
+    # Fetch one extra row to know whether another page exists
+    rows = query.order_by(id_column.desc()).limit(per_page + 1).all()
+    next_cursor = rows[per_page - 1].id if len(rows) > per_page else None
+    return rows[:per_page], next_cursor
+
+def filter_created(query, column):
+    """Apply the ``created_from`` / ``created_to`` (YYYY-MM-DD) query parameters"""
+    for name in ('created_from', 'created_to'):
+        value = request.args.get(name, '').strip()
+        if not value:
+            continue
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            continue
+        if name == 'created_from':
+            query = query.filter(column >= day)
+        else:
+            query = query.filter(column < day + timedelta(days=1))
+    return query
+
+def filter_prefix(query, column):
+    """Apply the ``q`` query parameter as a case-sensitive prefix match.
+
+    A plain range comparison is used instead of LIKE, because SQLite and
+    PostgreSQL only use an ordinary column index for LIKE under special collations.
+    """
+    q = request.args.get('q', '').strip()
+    if q:
+        query = query.filter(column >= q)
+        # Exclusive upper bound: the prefix with its last code point incremented, which
+        # sorts after every extension of the prefix (including characters above U+FFFF)
+        if ord(q[-1]) < 0x10ffff:
+            query = query.filter(column < q[:-1] + chr(ord(q[-1]) + 1))
+    return query
+
+def count_children(parent_column, parent_ids):
+    """Count child rows per parent id with a single grouped query"""
+    if not parent_ids:
+        return {}
+    rows = db.session.query(parent_column, db.func.count()) \
+                     .filter(parent_column.in_(parent_ids)) \
+                     .group_by(parent_column) \
+                     .all()
+    return dict(rows)
+
+# Photo storage helpers
+# Photos are stored once under their SHA-256 digest and shared by every Content row that uses them
+BLOB_FILENAME_RE = re.compile(r'^images/[0-9a-f]{64}\.(png|jpg|jpeg|gif)$')
+
+def store_photo(photo, extension):
+    """Stream an upload to disk while hashing it and return its (possibly shared) PhotoBlob.
+
+    The blob's reference count is incremented in the current transaction, so it is
+    committed together with the Content row that uses it.
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(upload_folder, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            while True:
+                chunk = photo.stream.read(app.config['UPLOAD_CHUNK_SIZE'])
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                tmp_file.write(chunk)
+
+        if size == 0:
+            return None
+
+        sha256 = digest.hexdigest()
+        filename = f"{sha256}.{extension}"
+        while True:
+            blob = PhotoBlob.query.filter_by(sha256=sha256).first()
+            if blob is None:
+                if os.path.isfile(tmp_path):
+                    os.replace(tmp_path, os.path.join(upload_folder, filename))
+                blob = _insert_photo_blob(sha256, f"images/{filename}", size)
+            else:
+                # Integrity check: restore the stored file if it went missing or was truncated
+                blob_file = os.path.join(upload_folder, os.path.basename(blob.path))
+                if os.path.isfile(tmp_path) and \
+                   (not os.path.isfile(blob_file) or os.path.getsize(blob_file) != blob.size):
+                    os.replace(tmp_path, blob_file)
+
+            # Increment in SQL so concurrent uploads can't lose an update; retry if the
+            # blob was released and deleted in the meantime
+            updated = PhotoBlob.query.filter_by(id=blob.id) \
+                                     .update({PhotoBlob.ref_count: PhotoBlob.ref_count + 1},
+                                             synchronize_session=False)
+            if updated:
+                return blob
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _insert_photo_blob(sha256, path, size):
+    """Insert a PhotoBlob with no references, or return the one a concurrent upload inserted first"""
+    db.session.add(PhotoBlob(
+        sha256=sha256,
+        path=path,
+        size=size,
+        ref_count=0,
+        created_at=datetime.utcnow()
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    return PhotoBlob.query.filter_by(sha256=sha256).one()
+
+def release_photo(photo_path):
+    """Drop one content reference to a stored photo; reclaim_photos() frees it later"""
+    # Uploads made before content-addressed storage have no PhotoBlob and are left alone
+    PhotoBlob.query.filter_by(path=photo_path) \
+                   .update({PhotoBlob.ref_count: PhotoBlob.ref_count - 1}, synchronize_session=False)
+
+def release_keyword_photos(keyword_ids):
+    """Release the photos of every content item belonging to the given keywords"""
+    if not keyword_ids:
+        return
+    photo_paths = db.session.query(Content.content_photo_path) \
+                            .filter(Content.keyword_id.in_(keyword_ids),
+                                    Content.content_type == 'photo') \
+                            .all()
+    for (photo_path,) in photo_paths:
+        if photo_path:
+            release_photo(photo_path)
+
+def reclaim_photos():
+    """Delete blobs that no content uses and no visible chat message shows.
+
+    Bot replies embed photo paths, so a blob without content references is kept
+    while a conversation of an existing activity still contains its path. Chat
+    history is scanned once for all candidates. Returns the file paths to remove
+    with remove_photo_files() once the caller has committed.
+    """
+    candidates = db.session.query(PhotoBlob.id, PhotoBlob.path) \
+                           .filter(PhotoBlob.ref_count <= 0) \
+                           .all()
+    if not candidates:
+        return []
+
+    shown = db.session.query(Conversation.message) \
+                      .join(Activity, Activity.id == Conversation.activity_id) \
+                      .filter(db.or_(*[Conversation.message.contains(path, autoescape=True)
+                                       for _, path in candidates])) \
+                      .all()
+    unused = [(blob_id, path) for blob_id, path in candidates
+              if not any(path in message for (message,) in shown)]
+    if not unused:
+        return []
+
+    PhotoBlob.query.filter(PhotoBlob.id.in_([blob_id for blob_id, _ in unused]),
+                           PhotoBlob.ref_count <= 0) \
+                   .delete(synchronize_session=False)
+    return [path for _, path in unused]
+
+def remove_photo_files(photo_paths):
+    """Delete released photo files; call only after the releasing transaction has committed"""
+    for photo_path in photo_paths:
+        if not photo_path or PhotoBlob.query.filter_by(path=photo_path).first() is not None:
+            # Nothing to remove, or the same photo was uploaded again in the meantime
+            continue
+        blob_file = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(photo_path))
+        if os.path.isfile(blob_file):
+            os.remove(blob_file)
+
+@app.after_request
+def cache_content_addressed_photos(response):
+    """Hashed photo names never change content, so browsers may cache them forever"""
+    # 304 revalidations must carry the same headers, or browsers apply no-cache to the stored copy
+    if request.endpoint == 'static' and response.status_code in (200, 304) and \
+       BLOB_FILENAME_RE.match(request.view_args.get('filename', '')):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    return response
+
+@app.template_global()
+def page_url(after=None):
+    """URL of the current list page with its filters kept and the cursor replaced"""
+    args = request.args.to_dict()
+    args.pop('after', None)
+    if after:
+        args['after'] = after
+    # Path parameters win over query arguments of the same name
+    return url_for(request.endpoint, **{**args, **request.view_args})
+
+# Public page renderers, shared by the routes and the static snapshot export
+def render_index_page():
+    """Render the home page with the latest activities"""
+    activities = Activity.query.order_by(Activity.created_at.desc()).limit(5).all()
+    return render_template('index.html', activities=activities)
+
+def render_activities_page():
+    """Render the full activity list, latest first"""
+    activities_list = Activity.query.order_by(Activity.created_at.desc()).all()
+    return render_template('activities.html', activities=activities_list)
+
+# Static snapshot helpers
+# Endpoint -> (URL path, renderer); each snapshot is written to SNAPSHOT_FOLDER/<endpoint>.html
+SNAPSHOT_PAGES = {
+    'index': ('/', render_index_page),
+    'activities': ('/activities', render_activities_page),
+}
+
+def export_snapshots():
+    """Render every snapshot page as an anonymous visitor and write the ones that changed"""
+    folder = app.config['SNAPSHOT_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+
+    written = []
+    for endpoint, (path, renderer) in SNAPSHOT_PAGES.items():
+        with app.test_request_context(path):
+            html = renderer()
+
+        target = os.path.join(folder, f"{endpoint}.html")
+        if os.path.isfile(target):
+            with open(target, encoding='utf-8') as existing:
+                if existing.read() == html:
+                    continue
+
+        # Write atomically, through a temp file unique to this writer, so a proxy never
+        # serves a half-written page and concurrent workers don't collide
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+                tmp_file.write(html)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        written.append(target)
+    return written
+
+def refresh_snapshots():
+    """Regenerate snapshots after an activity change, if snapshots have been exported.
+
+    The activity change is already committed, so a failure here is logged rather
+    than turned into an error page.
+    """
+    if not os.path.isdir(app.config['SNAPSHOT_FOLDER']):
+        return
+    try:
+        export_snapshots()
+    except Exception:
+        app.logger.exception('Could not refresh static snapshots')
+
+@app.cli.command('export-snapshots')
+def export_snapshots_command():
+    """Pre-render the public home and activity pages to static HTML"""
+    written = export_snapshots()
+    for target in written:
+        click.echo(f"Wrote {target}")
+    click.echo(f"{len(written)} of {len(SNAPSHOT_PAGES)} snapshots changed")
+
+@app.cli.command('gc-photos')
+def gc_photos_command():
+    """Delete stored photos that no content uses and no chat message shows"""
+    unused_photos = reclaim_photos()
+    db.session.commit()
+    remove_photo_files(unused_photos)
+    click.echo(f"Removed {len(unused_photos)} unused photos")
+
+@app.before_request
+def serve_snapshot():
+    """Serve the pre-rendered copy of a public page to anonymous visitors"""
+    if request.method != 'GET' or request.endpoint not in SNAPSHOT_PAGES or request.args:
+        return None
+    # Logged-in visitors see a personalised nav bar, and pending flashes must still be shown
+    if 'user_id' in session or 'admin_id' in session or '_flashes' in session:
+        return None
+
+    folder = os.path.abspath(app.config['SNAPSHOT_FOLDER'])
+    filename = f"{request.endpoint}.html"
+    if not os.path.isfile(os.path.join(folder, filename)):
+        return None
+    return send_from_directory(folder, filename, mimetype='text/html')
+
 # Routes
 @app.route('/')
+@read_replica
 def index():
     """Home page with introduction to 城市定向社团"""
-    # Get latest activities for display on homepage
-    activities = Activity.query.order_by(Activity.created_at.desc()).limit(5).all()
-    return render_template('index.html', activities=activities)
+    return render_index_page()
 
 @app.route('/activities')
+@read_replica
 def activities():
     """Display all activities in chronological order (latest first)"""
-    activities_list = Activity.query.order_by(Activity.created_at.desc()).all()
-    return render_template('activities.html', activities=activities_list)
+    return render_activities_page()
 
 @app.route('/activity/<int:activity_id>')
 def activity_detail(activity_id):
@@ -45,6 +476,7 @@ def activity_detail(activity_id):
 
 
 @app.route('/activity/<int:activity_id>/chat', methods=['GET', 'POST'])
+@read_replica
 def activity_chat(activity_id):
     """Chat with the activity bot"""
     if 'user_id' not in session:
@@ -86,7 +518,11 @@ def activity_chat(activity_id):
                 db.session.add(user_conversation)
 
                 # Don't create a bot response when no keyword matches
+                if app.config['PRERENDER_MESSAGES']:
+                    db.session.flush()
+                    store_message_html([user_conversation])
                 db.session.commit()
+                stick_to_primary()
                 return redirect(url_for('activity_chat', activity_id=activity_id))
 
             # If we have a keyword, proceed with normal flow
@@ -131,21 +567,86 @@ def activity_chat(activity_id):
             )
             db.session.add(bot_conversation)
 
+            if app.config['PRERENDER_MESSAGES']:
+                db.session.flush()
+                store_message_html([user_conversation, bot_conversation])
             db.session.commit()
+            stick_to_primary()
 
             return redirect(url_for('activity_chat', activity_id=activity_id))
 
-    # Get conversation history
-    conversations = Conversation.query.filter_by(
-        user_id=user_id,
-        activity_id=activity_id
-    ).order_by(Conversation.timestamp).all()
-
-    # Get the user object to access username
-    from models import User
-    user_obj = User.query.get(user_id)
-
-    return render_template('activity_chat.html', activity=activity, conversations=conversations, username=user_obj.username)
+    # With delta sync, a browser that already caches this chat loads its history from there and
+    # activity_chat_history. First visits and clients without JavaScript get it rendered here.
+    delta_sync = app.config['CHAT_DELTA_SYNC']
+    if delta_sync and request.cookies.get(app.config['CHAT_CACHE_COOKIE']) == '1':
+        return render_template('activity_chat.html', activity=activity, conversations=[], username=None,
+                               delta_sync=True)
+
+    # Get conversation history together with the username
+    user, conversations = load_chat_history(user_id, activity_id)
+    if app.config['PRERENDER_MESSAGES']:
+        conversations = fill_message_html(conversations)
+    else:
+        conversations = [conv._replace(html=None) for conv in conversations]
+
+    # The page's scripts seed the browser cache from these bubbles, tagged with the cache owner
+    return render_template('activity_chat.html', activity=activity, conversations=conversations,
+                           username=user.username if user else None, delta_sync=delta_sync,
+                           cache_owner=chat_cache_owner(user) if user else '')
+
+@app.route('/activity/<int:activity_id>/chat/history')
+@read_replica
+def activity_chat_history(activity_id):
+    """Chat messages newer than the client's cached copy, as JSON.
+
+    The client sends the last message id it has (``after``), how many messages it
+    has cached (``count``) and the ``owner`` token of its cache. If any of these no
+    longer match the database, for example because messages were deleted with the
+    account, the full history is returned with ``reset`` set.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Please login to chat with the bot'}), 401
+
+    Activity.query.get_or_404(activity_id)
+    after_id = request.args.get('after', 0, type=int)
+    user, messages = load_chat_history(session['user_id'], activity_id,
+                                       after_id=after_id if after_id > 0 else None)
+    if user is None and g.get('use_replica'):
+        # A new account may not have reached the replica yet
+        read_from_primary()
+        user, messages = load_chat_history(session['user_id'], activity_id,
+                                           after_id=after_id if after_id > 0 else None)
+    if user is None:
+        abort(404)
+    owner = chat_cache_owner(user)
+
+    reset = after_id <= 0 or request.args.get('owner') != owner
+    if not reset:
+        cached_count, cached_head = db.session.query(db.func.count(Conversation.id), db.func.max(Conversation.id)) \
+                                              .filter(Conversation.user_id == user.id,
+                                                      Conversation.activity_id == activity_id,
+                                                      Conversation.id <= after_id) \
+                                              .one()
+        reset = cached_count != request.args.get('count', type=int) or cached_head != after_id
+    if reset and after_id > 0:
+        # The client's cache is stale, so send the whole history instead of the delta
+        _, messages = load_chat_history(user.id, activity_id)
+    if app.config['PRERENDER_MESSAGES']:
+        messages = fill_message_html(messages)
+    else:
+        messages = [msg._replace(html=render_message_html(msg.message)) for msg in messages]
+
+    return jsonify({
+        'reset': reset,
+        'owner': owner,
+        'username': user.username,
+        'messages': [{
+            'id': msg.id,
+            'sender_type': msg.sender_type,
+            'html': msg.html,
+            'time': msg.timestamp.strftime('%H:%M')
+        } for msg in messages]
+    })
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -160,6 +661,7 @@ def login():
             session['admin_id'] = admin.id
             session['admin_role'] = admin.role
             session['user_type'] = 'admin'  # Add this to distinguish admin session
+            stick_to_primary()
             return redirect(url_for('index'))
 
         # Check if it's a regular user login
@@ -167,6 +669,7 @@ def login():
         if user and check_password_hash(user.password_hash, password):
             session['user_id'] = user.id
             session['user_type'] = 'user'
+            stick_to_primary()
             return redirect(url_for('index'))
 
         # If neither, show error
@@ -198,6 +701,7 @@ def register():
         
         db.session.add(new_user)
         db.session.commit()
+        stick_to_primary()
         
         flash('Registration successful')
         return redirect(url_for('login'))
@@ -205,23 +709,33 @@ def register():
     return render_template('user/register.html')
 
 @app.route('/profile')
+@read_replica
 def user_profile():
     """User profile with conversation history"""
     if 'user_id' not in session:
         flash('Please login to view your profile')
         return redirect(url_for('login'))
 
-    user = User.query.get_or_404(session['user_id'])
-    # Get all conversations for this user
-    conversations = db.session.query(Conversation, Activity) \
-                    .join(Activity) \
-                    .filter(Conversation.user_id == user.id) \
-                    .order_by(Conversation.timestamp.desc()) \
-                    .all()
+    # Get the user and all of their conversations with one query
+    user, conversations = load_chat_history(session['user_id'], newest_first=True, with_html=False)
+    if user is None and g.get('use_replica'):
+        # A new account may not have reached the replica yet
+        read_from_primary()
+        user, conversations = load_chat_history(session['user_id'], newest_first=True, with_html=False)
+    if user is None:
+        abort(404)
+    activity_ids = {conv.activity_id for conv in conversations}
+    activities_by_id = {}
+    if activity_ids:
+        activities = Activity.query.filter(Activity.id.in_(activity_ids)).all()
+        activities_by_id = {activity.id: activity for activity in activities}
 
     # Group conversations by activity
     conversations_by_activity = {}
-    for conv, activity in conversations:
+    for conv in conversations:
+        activity = activities_by_id.get(conv.activity_id)
+        if activity is None:
+            continue
         if activity.id not in conversations_by_activity:
             conversations_by_activity[activity.id] = {
                 'activity': activity,
@@ -241,7 +755,10 @@ def logout():
     session.pop('admin_id', None)
     session.pop('admin_role', None)
     session.pop('user_type', None)
-    return redirect(url_for('index'))
+    response = redirect(url_for('index'))
+    # Drop the cached chat histories as well; the logout links also clear them for plain HTTP
+    response.headers['Clear-Site-Data'] = '"storage"'
+    return response
 
 
 @app.route('/user/delete', methods=['POST'])
@@ -254,12 +771,17 @@ def delete_own_user_account():
     user_id = session['user_id']
     user = User.query.get_or_404(user_id)
 
-    # Delete all conversations for this user
+    # Delete all conversations for this user, along with their pre-rendered HTML
+    conversation_ids = db.session.query(Conversation.id).filter_by(user_id=user_id)
+    RenderedMessage.query.filter(RenderedMessage.conversation_id.in_(conversation_ids.scalar_subquery())) \
+                         .delete(synchronize_session=False)
     Conversation.query.filter_by(user_id=user_id).delete()
 
-    # Delete the user account
+    # Delete the user account, and any photos only their chat history was still showing
     db.session.delete(user)
+    unused_photos = reclaim_photos()
     db.session.commit()
+    remove_photo_files(unused_photos)
 
     # Clear the session
     session.clear()
@@ -283,9 +805,13 @@ def admin_dashboard():
         flash('Please login as admin')
         return redirect(url_for('login'))
     
-    # Get all activities
-    activities = Activity.query.all()
-    return render_template('admin/dashboard.html', activities=activities, admin_role=session['admin_role'])
+    query = filter_prefix(Activity.query, Activity.title)
+    query = filter_created(query, Activity.created_at)
+    activities, next_cursor = keyset_page(query, Activity.id)
+    keyword_counts = count_children(Keyword.activity_id, [a.id for a in activities])
+
+    return render_template('admin/dashboard.html', activities=activities, admin_role=session['admin_role'],
+                           keyword_counts=keyword_counts, next_cursor=next_cursor)
 
 @app.route('/admin/activity/new', methods=['GET', 'POST'])
 def create_activity():
@@ -309,6 +835,7 @@ def create_activity():
         
         db.session.add(new_activity)
         db.session.commit()
+        refresh_snapshots()
         
         flash('Activity created successfully')
         return redirect(url_for('admin_dashboard'))
@@ -331,6 +858,7 @@ def edit_activity(activity_id):
         activity.updated_at = datetime.utcnow()
         
         db.session.commit()
+        refresh_snapshots()
         flash('Activity updated successfully')
         return redirect(url_for('admin_dashboard'))
     
@@ -347,13 +875,17 @@ def delete_activity(activity_id):
 
     # Delete related keywords and content
     keywords = Keyword.query.filter_by(activity_id=activity_id).all()
+    release_keyword_photos([keyword.id for keyword in keywords])
     for keyword in keywords:
         # Delete related content
         Content.query.filter_by(keyword_id=keyword.id).delete()
         db.session.delete(keyword)
 
     db.session.delete(activity)
+    unused_photos = reclaim_photos()
     db.session.commit()
+    remove_photo_files(unused_photos)
+    refresh_snapshots()
 
     flash('Activity deleted successfully')
     return redirect(url_for('admin_dashboard'))
@@ -367,9 +899,13 @@ def manage_keywords(activity_id):
         return redirect(url_for('login'))
 
     activity = Activity.query.get_or_404(activity_id)
-    keywords = Keyword.query.filter_by(activity_id=activity_id).all()
+    query = filter_prefix(Keyword.query.filter_by(activity_id=activity_id), Keyword.keyword)
+    query = filter_created(query, Keyword.created_at)
+    keywords, next_cursor = keyset_page(query, Keyword.id)
+    content_counts = count_children(Content.keyword_id, [k.id for k in keywords])
 
-    return render_template('admin/manage_keywords.html', activity=activity, keywords=keywords)
+    return render_template('admin/manage_keywords.html', activity=activity, keywords=keywords,
+                           content_counts=content_counts, next_cursor=next_cursor)
 
 
 @app.route('/admin/activity/<int:activity_id>/keyword/new', methods=['GET', 'POST'])
@@ -433,10 +969,13 @@ def delete_keyword(keyword_id):
     activity_id = keyword.activity_id
 
     # Delete related content
+    release_keyword_photos([keyword_id])
     Content.query.filter_by(keyword_id=keyword_id).delete()
 
     db.session.delete(keyword)
+    unused_photos = reclaim_photos()
     db.session.commit()
+    remove_photo_files(unused_photos)
 
     flash('Keyword deleted successfully')
     return redirect(url_for('manage_keywords', activity_id=activity_id))
@@ -450,9 +989,15 @@ def manage_content(keyword_id):
         return redirect(url_for('login'))
 
     keyword = Keyword.query.get_or_404(keyword_id)
-    content_items = Content.query.filter_by(keyword_id=keyword_id).all()
+    query = Content.query.filter_by(keyword_id=keyword_id)
+    content_type = request.args.get('content_type')
+    if content_type in ('text', 'photo'):
+        query = query.filter(Content.content_type == content_type)
+    query = filter_created(query, Content.created_at)
+    content_items, next_cursor = keyset_page(query, Content.id)
 
-    return render_template('admin/manage_content.html', keyword=keyword, content_items=content_items)
+    return render_template('admin/manage_content.html', keyword=keyword, content_items=content_items,
+                           next_cursor=next_cursor)
 
 
 @app.route('/admin/keyword/<int:keyword_id>/content/new', methods=['GET', 'POST'])
@@ -483,20 +1028,16 @@ def create_content(keyword_id):
                 if '.' in photo.filename and \
                    photo.filename.rsplit('.', 1)[1].lower() in allowed_extensions:
 
-                    # Generate unique filename
-                    import uuid
-                    filename = f"{uuid.uuid4()}_{photo.filename}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-
-                    # Create upload directory if it doesn't exist
-                    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-                    photo.save(filepath)
+                    # Store by content hash so identical photos share one file
+                    blob = store_photo(photo, photo.filename.rsplit('.', 1)[1].lower())
+                    if blob is None:
+                        flash('The uploaded photo is empty')
+                        return redirect(url_for('create_content', keyword_id=keyword_id))
 
                     new_content = Content(
                         keyword_id=keyword_id,
                         content_type=content_type,
-                        content_photo_path=f"images/{filename}",
+                        content_photo_path=blob.path,
                         created_at=datetime.utcnow()
                     )
                 else:
@@ -517,6 +1058,28 @@ def create_content(keyword_id):
 
     return render_template('admin/create_content.html', keyword=keyword)
 
+
+@app.route('/admin/content/<int:content_id>/delete', methods=['POST'])
+def delete_content(content_id):
+    """Delete a content item - only accessible to admins"""
+    if 'admin_id' not in session:
+        flash('Please login as admin')
+        return redirect(url_for('login'))
+
+    content = Content.query.get_or_404(content_id)
+    keyword_id = content.keyword_id
+
+    if content.content_type == 'photo' and content.content_photo_path:
+        release_photo(content.content_photo_path)
+
+    db.session.delete(content)
+    unused_photos = reclaim_photos()
+    db.session.commit()
+    remove_photo_files(unused_photos)
+
+    flash('Content deleted successfully')
+    return redirect(url_for('manage_content', keyword_id=keyword_id))
+
 @app.route('/admin/users')
 def manage_users():
     """Manage admin accounts - only accessible to root admin"""
@@ -524,8 +1087,9 @@ def manage_users():
         flash('Access denied')
         return redirect(url_for('login'))
     
-    admins = Admin.query.all()
-    return render_template('admin/manage_users.html', admins=admins)
+    query = filter_prefix(Admin.query, Admin.username)
+    admins, next_cursor = keyset_page(query, Admin.id)
+    return render_template('admin/manage_users.html', admins=admins, next_cursor=next_cursor)
 
 @app.route('/admin/user/new', methods=['GET', 'POST'])
 def create_admin():
@@ -4,9 +4,13 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///urban_orientation.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Optional read-only replica used by read-heavy routes
+    SQLALCHEMY_BINDS = {'replica': os.environ['REPLICA_DATABASE_URL']} if os.environ.get('REPLICA_DATABASE_URL') else {}
+    REPLICA_STICKY_SECONDS = 10
     UPLOAD_FOLDER = 'static/images'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    ADMIN_PAGE_SIZE = 20  # Rows per page on admin list pages
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -1,20 +1,28 @@
+from collections import namedtuple
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 
 # Global variable to hold the db instance
 _db = None
 
+# Read-only projection of a Conversation row used when rendering chat history
+ChatMessage = namedtuple('ChatMessage', ['id', 'activity_id', 'sender_type', 'message', 'timestamp', 'html'])
+# Read-only projection of the User row loaded alongside the chat history
+ChatUser = namedtuple('ChatUser', ['id', 'username', 'email', 'created_at'])
+
 def init_db(database):
     global _db
     _db = database
     # Now that _db is set, we can define the models
-    global User, Admin, Activity, Keyword, Content, Conversation
+    global User, Admin, Activity, Keyword, Content, Conversation, PhotoBlob, RenderedMessage
     User = _create_user_model()
     Admin = _create_admin_model()
     Activity = _create_activity_model()
     Keyword = _create_keyword_model()
     Content = _create_content_model()
     Conversation = _create_conversation_model()
+    PhotoBlob = _create_photo_blob_model()
+    RenderedMessage = _create_rendered_message_model()
 
 def _create_user_model():
     class User(_db.Model):
@@ -52,10 +60,10 @@ def _create_activity_model():
         __tablename__ = 'activities'
 
         id = _db.Column(_db.Integer, primary_key=True)
-        title = _db.Column(_db.String(200), nullable=False)
+        title = _db.Column(_db.String(200), nullable=False, index=True)
         description = _db.Column(_db.Text)
         bot_name = _db.Column(_db.String(100), default='Activity Bot')
-        created_at = _db.Column(_db.DateTime, default=datetime.utcnow)
+        created_at = _db.Column(_db.DateTime, default=datetime.utcnow, index=True)
         updated_at = _db.Column(_db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
         # Relationship with keywords
@@ -72,7 +80,10 @@ def _create_keyword_model():
         id = _db.Column(_db.Integer, primary_key=True)
         activity_id = _db.Column(_db.Integer, _db.ForeignKey('activities.id'), nullable=False)
         keyword = _db.Column(_db.String(100), nullable=False)
-        created_at = _db.Column(_db.DateTime, default=datetime.utcnow)
+        created_at = _db.Column(_db.DateTime, default=datetime.utcnow, index=True)
+
+        # Keyword text search is always scoped to one activity; also serves lookups by activity_id
+        __table_args__ = (_db.Index('ix_keywords_activity_keyword', 'activity_id', 'keyword'),)
 
         # Relationship with content
         content = _db.relationship('Content', backref='keyword', lazy=True, cascade='all, delete-orphan')
@@ -88,11 +99,11 @@ def _create_content_model():
         __tablename__ = 'content'
 
         id = _db.Column(_db.Integer, primary_key=True)
-        keyword_id = _db.Column(_db.Integer, _db.ForeignKey('keywords.id'), nullable=False)
-        content_type = _db.Column(_db.String(10), default='text')  # 'text' or 'photo'
+        keyword_id = _db.Column(_db.Integer, _db.ForeignKey('keywords.id'), nullable=False, index=True)
+        content_type = _db.Column(_db.String(10), default='text', index=True)  # 'text' or 'photo'
         content_text = _db.Column(_db.Text)
         content_photo_path = _db.Column(_db.String(200))  # Path to stored photo
-        created_at = _db.Column(_db.DateTime, default=datetime.utcnow)
+        created_at = _db.Column(_db.DateTime, default=datetime.utcnow, index=True)
 
         def __repr__(self):
             return f'<Content {self.content_type} for keyword {self.keyword.keyword}>'
@@ -110,10 +121,40 @@ def _create_conversation_model():
         timestamp = _db.Column(_db.DateTime, default=datetime.utcnow)
         sender_type = _db.Column(_db.String(10), default='user')  # 'user' or 'bot'
 
+        # Chat history is always read per user (and usually per activity) in time order
+        __table_args__ = (_db.Index('ix_conversations_user_activity_time', 'user_id', 'activity_id', 'timestamp'),)
+
         def __repr__(self):
             return f'<Conversation by {self.user.username} at {self.timestamp}>'
 
         def is_bot_message(self):
             """Check if this is a bot message"""
             return self.sender_type == 'bot'
-    return Conversation
\ No newline at end of file
+    return Conversation
+
+def _create_photo_blob_model():
+    class PhotoBlob(_db.Model):
+        __tablename__ = 'photo_blobs'
+
+        id = _db.Column(_db.Integer, primary_key=True)
+        sha256 = _db.Column(_db.String(64), unique=True, nullable=False)
+        path = _db.Column(_db.String(200), unique=True, nullable=False)  # Path relative to static/
+        size = _db.Column(_db.Integer, nullable=False)
+        ref_count = _db.Column(_db.Integer, default=0, nullable=False)  # Number of Content rows using it
+        created_at = _db.Column(_db.DateTime, default=datetime.utcnow)
+
+        def __repr__(self):
+            return f'<PhotoBlob {self.sha256[:12]} refs={self.ref_count}>'
+    return PhotoBlob
+
+def _create_rendered_message_model():
+    class RenderedMessage(_db.Model):
+        __tablename__ = 'rendered_messages'
+
+        conversation_id = _db.Column(_db.Integer, _db.ForeignKey('conversations.id'), primary_key=True)
+        html = _db.Column(_db.Text, nullable=False)  # Escaped output of partials/message_content.html
+        template_version = _db.Column(_db.String(16), nullable=False)  # Partial version used to render it
+
+        def __repr__(self):
+            return f'<RenderedMessage for conversation {self.conversation_id}>'
+    return RenderedMessage
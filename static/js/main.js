@@ -36,4 +36,118 @@ function scrollToBottom() {
 // Initialize chat functionality when DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
     scrollToBottom();
-});
\ No newline at end of file
+});
+
+// Chat history cache: each conversation is kept in localStorage and only new messages are fetched
+const CHAT_CACHE_PREFIX = 'chat:';
+
+function loadChatCache(key) {
+    try {
+        const cache = JSON.parse(localStorage.getItem(key));
+        if (cache && Array.isArray(cache.messages)) {
+            return cache;
+        }
+    } catch (e) {
+        // Unreadable cache entries are simply rebuilt from the server
+    }
+    return { owner: '', username: '', messages: [] };
+}
+
+function saveChatCache(key, cache) {
+    try {
+        localStorage.setItem(key, JSON.stringify(cache));
+        return true;
+    } catch (e) {
+        // Storage full or disabled: the chat still works, it just isn't cached
+        return false;
+    }
+}
+
+// Tells the server whether this browser holds a cached copy of the chat, so it can skip
+// rendering the history; without the cookie the server renders it into the page
+function setChatCacheCookie(container, cached) {
+    const maxAge = cached ? 30 * 24 * 3600 : 0;
+    document.cookie = container.dataset.cacheCookie + '=1; path=' + container.dataset.chatPath +
+        '; max-age=' + maxAge + '; SameSite=Lax';
+}
+
+// Remove every cached conversation, e.g. before the account is deleted
+function clearChatCache() {
+    try {
+        Object.keys(localStorage)
+            .filter(key => key.startsWith(CHAT_CACHE_PREFIX))
+            .forEach(key => localStorage.removeItem(key));
+    } catch (e) {
+        // Nothing to clear when storage is unavailable
+    }
+}
+
+function renderChatMessages(container, messages, username) {
+    const welcome = document.getElementById('welcome-message');
+    if (welcome) {
+        welcome.style.display = container.querySelector('[data-message-id]') || messages.length ? 'none' : '';
+    }
+
+    messages.forEach(msg => {
+        const templateId = msg.sender_type === 'user' ? 'user-message-template' : 'bot-message-template';
+        const bubble = document.getElementById(templateId).content.firstElementChild.cloneNode(true);
+        bubble.dataset.messageId = msg.id;
+        // The HTML was escaped on the server when the message was rendered
+        bubble.querySelector('.message-body').innerHTML = msg.html;
+        bubble.querySelector('.message-time').textContent = msg.time;
+        const initial = bubble.querySelector('.user-initial');
+        if (initial && username) {
+            initial.textContent = username.slice(0, 1).toUpperCase();
+        }
+        container.appendChild(bubble);
+    });
+    container.scrollTop = container.scrollHeight;
+}
+
+// Build the cache from a history the server rendered into the page, so it isn't downloaded twice
+function readRenderedChat(container) {
+    const messages = Array.from(container.querySelectorAll('[data-message-id]'), bubble => ({
+        id: Number(bubble.dataset.messageId),
+        sender_type: bubble.dataset.sender,
+        html: bubble.querySelector('.message-body').innerHTML,
+        time: bubble.querySelector('.message-time').textContent
+    }));
+    return { owner: container.dataset.owner, username: container.dataset.username, messages: messages };
+}
+
+function syncChatHistory(container) {
+    const key = container.dataset.cacheKey;
+    // A server-rendered page carries the whole history; otherwise it comes from the cache
+    const serverRendered = container.dataset.owner !== undefined;
+    let cache = serverRendered ? readRenderedChat(container) : loadChatCache(key);
+
+    if (cache.messages.length && !serverRendered) {
+        // Show the cached history straight away, then ask only for what is newer
+        renderChatMessages(container, cache.messages, cache.username);
+    } else if (!serverRendered) {
+        // Nothing cached: have the server render the history next time if this sync fails
+        setChatCacheCookie(container, false);
+    }
+    const lastId = cache.messages.reduce((max, msg) => Math.max(max, msg.id), 0);
+    const params = new URLSearchParams({ after: lastId, count: cache.messages.length, owner: cache.owner });
+
+    fetch(container.dataset.historyUrl + '?' + params.toString(), { credentials: 'same-origin' })
+        .then(response => response.ok ? response.json() : Promise.reject(response.status))
+        .then(data => {
+            if (data.reset) {
+                // Cache no longer matches the server (messages deleted or another account)
+                container.querySelectorAll('[data-message-id]').forEach(el => el.remove());
+                cache = { owner: '', username: '', messages: [] };
+            }
+            cache.owner = data.owner;
+            cache.username = data.username;
+            cache.messages = cache.messages.concat(data.messages);
+            renderChatMessages(container, data.messages, data.username);
+            if (saveChatCache(key, cache)) {
+                setChatCacheCookie(container, true);
+            }
+        })
+        .catch(() => {
+            // Offline or server error: keep showing the cached history
+        });
+}